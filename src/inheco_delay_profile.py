@@ -0,0 +1,277 @@
+"""Per-device read delay profiles for the Inheco Single Plate Incubator Shaker.
+
+A profile maps command prefixes to the number of seconds to wait before reading the
+device response. Profiles are measured against a specific device with calibrate() and
+saved as json next to the device log, one file per port/device ID/serial number.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import statistics
+import threading
+
+logger = logging.getLogger(__name__)
+
+# read delays used before a device has been calibrated
+DEFAULT_READ_DELAY = 0.5
+DEFAULT_READ_DELAYS = {
+    "AID": 3,  # initialize
+    "SRS": 5,  # reset
+    "AOD": 6,  # open door
+    "ACD": 7,  # close door
+    "ASE0": 5,  # stop shaker
+    "ASE": 3,  # start shaker
+    "STT": 0.5,  # set target temperature
+    "SHE": 0.5,  # start/stop heater
+    "SSP": 0.5,  # set shaker parameters
+}
+
+# commands measured by calibrate(), in the order they are run each iteration.
+# Setpoints use the module defaults (22.0 C, heater off, 2.0 mm at 14.2 Hz) and are
+# cleared by the reset at the start of the next iteration. Queries are all timed
+# under the "default" key since they respond alike.
+CALIBRATION_SEQUENCE = [
+    ("SRS", "SRS"),
+    ("AID", "AID"),
+    ("AOD", "AOD"),
+    ("ACD", "ACD"),
+    ("STT", "STT220"),
+    ("SHE", "SHE"),
+    ("SSP", "SSP20,20,142,142,000"),
+    ("ASE", "ASEND"),
+    ("ASE0", "ASE0"),
+    ("default", "REF"),
+    ("default", "RAT"),
+    ("default", "RTT"),
+    ("default", "RHE"),
+    ("default", "RSE"),
+    ("default", "RDS"),
+    ("default", "RLW"),
+]
+
+
+def profile_path(port, device_id, serial_number=None, profile_dir="."):
+    """Returns the profile file path for a device
+
+    Arguments:
+        port: (str) COM port the device is connected to
+        device_id: (int) ID of the inheco device
+        serial_number: (str) optional device serial number, included in the file name when given
+        profile_dir: (str) directory holding profile files, default current directory
+    """
+    name = f"inheco_delay_profile_{port}_deviceID{device_id}"
+    if serial_number:
+        name += f"_{serial_number}"
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    return os.path.join(profile_dir, name + ".json")
+
+
+def summarize(samples, confidence_z=3.0, safety_margin=0.2):
+    """Summarizes measured response times and derives a read delay from them
+
+    The read delay is the larger of the slowest observed response and the
+    mean + confidence_z standard deviations, scaled up by the safety margin.
+
+    Arguments:
+        samples: (list of float) measured response times in seconds
+        confidence_z: (float) standard deviations above the mean to cover, default 3.0 (~99.9% one-sided)
+        safety_margin: (float) fractional margin added on top of the bound, default .2 (20%)
+
+    Returns:
+        summary: (dict) samples, mean, stdev, max, and read_delay in seconds
+    """
+    if not samples:
+        raise ValueError("Error: no samples to summarize")
+    mean = statistics.fmean(samples)
+    stdev = statistics.stdev(samples) if len(samples) > 1 else 0.0
+    upper_bound = max(max(samples), mean + confidence_z * stdev)
+    return {
+        "samples": len(samples),
+        "mean": round(mean, 3),
+        "stdev": round(stdev, 3),
+        "max": round(max(samples), 3),
+        "read_delay": round(upper_bound * (1 + safety_margin), 3),
+    }
+
+
+class DelayProfile:
+    """
+    Read delays for one Inheco device, loaded from and saved to a json profile file
+    """
+
+    def __init__(self, path=None, read_delays=None, default_read_delay=DEFAULT_READ_DELAY, metadata=None):
+        """Creates a profile, falling back to the built-in delays for any command not given
+
+        Arguments:
+            path: (str) file the profile is saved to, None to keep it in memory only
+            read_delays: (dict) command prefix to read delay in seconds
+            default_read_delay: (float) read delay for commands with no matching prefix
+            metadata: (dict) device and calibration details stored alongside the delays
+        """
+        self.path = path
+        self.read_delays = dict(DEFAULT_READ_DELAYS)
+        self.read_delays.update(read_delays or {})
+        self.default_read_delay = default_read_delay
+        self.metadata = metadata or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Loads the profile at path, or returns the built-in delays if no profile has been saved there yet"""
+        if not os.path.exists(path):
+            logger.info(f"no delay profile at {path}, using default read delays")
+            return cls(path=path)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            commands = data.get("commands", {})
+            read_delays = {key: value["read_delay"] for key, value in commands.items() if key != "default"}
+            default_read_delay = commands.get("default", {}).get("read_delay", DEFAULT_READ_DELAY)
+            logger.info(f"loaded delay profile from {path}")
+            return cls(path, read_delays, default_read_delay, data)
+        except Exception as e:
+            logger.error(f"Unable to load delay profile {path}, using default read delays: {e}")
+            return cls(path=path)
+
+    def save(self):
+        """Writes the profile to self.path"""
+        if self.path is None:
+            return
+        with self.lock:
+            data = dict(self.metadata)
+            commands = dict(data.get("commands", {}))
+            for key, read_delay in list(self.read_delays.items()) + [("default", self.default_read_delay)]:
+                commands[key] = dict(commands.get(key, {}), read_delay=read_delay)
+            data["commands"] = commands
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp_path, self.path)
+        logger.info(f"saved delay profile to {self.path}")
+
+    def key_for(self, message_string):
+        """Returns the profile key for a message, the longest matching command prefix or "default" """
+        matches = [key for key in self.read_delays if message_string.startswith(key)]
+        if not matches:
+            return "default"
+        return max(matches, key=len)
+
+    def read_delay(self, message_string):
+        """Returns the read delay in seconds for a message"""
+        key = self.key_for(message_string)
+        if key == "default":
+            return self.default_read_delay
+        return self.read_delays[key]
+
+    def widen(self, message_string, factor=1.5, max_read_delay=30.0):
+        """Increases the read delay for a message after its response was read too early and saves the profile
+
+        Arguments:
+            message_string: (str) message whose response was not ready after its read delay
+            factor: (float) multiplier applied to the current read delay, default 1.5
+            max_read_delay: (float) upper limit on the widened delay in seconds, default 30
+
+        Returns:
+            read_delay: (float) the new read delay in seconds
+        """
+        key = self.key_for(message_string)
+        read_delay = round(min(self.read_delay(message_string) * factor, max_read_delay), 3)
+        with self.lock:
+            if key == "default":
+                self.default_read_delay = read_delay
+            else:
+                self.read_delays[key] = read_delay
+            early_reads = self.metadata.setdefault("early_reads", {})
+            early_reads[key] = early_reads.get(key, 0) + 1
+        logger.warning(f"read delay for {key} widened to {read_delay} seconds after an early read")
+        try:
+            self.save()
+        except Exception as e:
+            logger.error(f"Unable to save delay profile {self.path}: {e}")
+        return read_delay
+
+
+def calibrate(interface, iterations=20, confidence_z=3.0, safety_margin=0.2, serial_number=None):
+    """Measures the device response time of each calibration command and saves a profile for the device
+
+    Note: this initializes and resets the device, opens and closes the door, and starts and stops
+    the shaker, iterations times each. Make sure the incubator is empty before calibrating.
+
+    Arguments:
+        interface: (Interface) connected incubator interface to calibrate
+        iterations: (int) number of times each command is measured, default 20
+        confidence_z: (float) standard deviations above the mean the read delay must cover, default 3.0
+        safety_margin: (float) fractional margin added to the measured bound, default .2 (20%)
+        serial_number: (str) optional device serial number recorded in the profile
+
+    Returns:
+        profile: (DelayProfile) the new profile, also loaded into the interface
+    """
+    if iterations < 2:
+        raise ValueError("Error: at least 2 iterations are needed to calibrate")
+
+    samples = {}
+    for iteration in range(iterations):
+        logger.info(f"calibration iteration {iteration + 1} of {iterations}")
+        for key, message in CALIBRATION_SEQUENCE:
+            elapsed = interface.measure_response_time(message)
+            samples.setdefault(key, []).append(elapsed)
+            logger.debug(f"calibration {message}: {elapsed:.3f} seconds")
+
+    commands = {key: summarize(values, confidence_z, safety_margin) for key, values in samples.items()}
+    metadata = {
+        "port": interface.port,
+        "device_id": interface.device_id,
+        "serial_number": serial_number,
+        "calibrated_at": datetime.datetime.now().isoformat(),
+        "iterations": iterations,
+        "confidence_z": confidence_z,
+        "safety_margin": safety_margin,
+        "commands": commands,
+    }
+    profile = DelayProfile(
+        path=interface.delay_profile.path,
+        read_delays={key: value["read_delay"] for key, value in commands.items() if key != "default"},
+        default_read_delay=commands["default"]["read_delay"],
+        metadata=metadata,
+    )
+    profile.save()
+    interface.delay_profile = profile
+    return profile
+
+
+if __name__ == "__main__":
+    from inheco_incubator_interface import Interface
+
+    parser = argparse.ArgumentParser(description="Calibrate read delays for an Inheco incubator")
+    parser.add_argument("--device", type=str, help="Serial port for communicating with the device", default="COM5")
+    parser.add_argument(
+        "--dll_path",
+        type=str,
+        help="path to incubator control dll (ComLib.dll)",
+        default="C:\\Program Files\\INHECO\\Incubator-Control\\ComLib.dll",
+    )
+    parser.add_argument("--device_id", type=int, help="device ID of the Inheco Incubator device", default=2)
+    parser.add_argument("--stack_floor", type=int, help="stack floor of the Inheco Incubator device", default=0)
+    parser.add_argument("--serial_number", type=str, help="serial number of the Inheco Incubator device", default=None)
+    parser.add_argument("--profile_dir", type=str, help="directory to save the delay profile in", default=".")
+    parser.add_argument("--iterations", type=int, help="number of times each command is measured", default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    com = Interface(
+        dll_path=args.dll_path,
+        port=args.device,
+        device_id=args.device_id,
+        stack_floor=args.stack_floor,
+        serial_number=args.serial_number,
+        profile_dir=args.profile_dir,
+    )
+    result = calibrate(com, iterations=args.iterations, serial_number=args.serial_number)
+    com.close_connection()
+    print(json.dumps(result.metadata["commands"], indent=4))
+    print(f"Delay profile saved to {result.path}")
@@ -0,0 +1,206 @@
+"""Incremental quality control summaries for Inheco incubation runs.
+
+Readings are folded into running statistics as they arrive, so a run of any length
+is summarized in constant memory without keeping the raw samples.
+"""
+
+import math
+
+
+class RunningStats:
+    """
+    Running count, mean, standard deviation, min and max of a stream of values (Welford's method)
+    """
+
+    def __init__(self):
+        """Creates empty running statistics"""
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, value):
+        """Adds one value to the statistics"""
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def stdev(self):
+        """Sample standard deviation, 0 with fewer than two values"""
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def summary(self, digits=2):
+        """Returns the statistics as a dict, values are None if nothing was recorded"""
+        if self.count == 0:
+            return {"samples": 0, "mean": None, "stdev": None, "min": None, "max": None}
+        return {
+            "samples": self.count,
+            "mean": round(self.mean, digits),
+            "stdev": round(self.stdev, digits),
+            "min": round(self.min, digits),
+            "max": round(self.max, digits),
+        }
+
+
+class ToleranceTracker:
+    """
+    Running statistics for one reading compared against its setpoint, including time spent within tolerance
+    """
+
+    def __init__(self, target, tolerance):
+        """Creates a tracker for readings expected to stay within tolerance of target"""
+        self.target = target
+        self.tolerance = tolerance
+        self.stats = RunningStats()
+        self.seconds_observed = 0.0
+        self.seconds_in_tolerance = 0.0
+        self.last_timestamp = None
+        self.last_in_tolerance = None
+
+    def update(self, timestamp, value):
+        """Adds one reading taken at timestamp (seconds).
+
+        Time between readings is credited to the state seen at the earlier reading.
+        """
+        if self.last_timestamp is not None:
+            elapsed = max(timestamp - self.last_timestamp, 0.0)
+            self.seconds_observed += elapsed
+            if self.last_in_tolerance:
+                self.seconds_in_tolerance += elapsed
+        self.stats.update(value)
+        self.last_timestamp = timestamp
+        self.last_in_tolerance = abs(value - self.target) <= self.tolerance
+
+    def summary(self, digits=2):
+        """Returns the statistics and time in tolerance as a dict"""
+        summary = self.stats.summary(digits)
+        summary["target"] = self.target
+        summary["tolerance"] = self.tolerance
+        summary["seconds_observed"] = round(self.seconds_observed, 1)
+        summary["seconds_in_tolerance"] = round(self.seconds_in_tolerance, 1)
+        summary["fraction_in_tolerance"] = (
+            round(self.seconds_in_tolerance / self.seconds_observed, 3)
+            if self.seconds_observed > 0
+            else None
+        )
+        return summary
+
+
+class IncubationQC:
+    """
+    Summarizes the temperature and shaking conditions a plate saw during one incubation
+    """
+
+    def __init__(
+        self,
+        target_temperature,
+        temperature_tolerance=0.5,
+        target_frequency=None,
+        frequency_tolerance=0.5,
+        target_amplitude=None,
+        amplitude_tolerance=0.2,
+    ):
+        """Creates an empty summary for an incubation
+
+        Arguments:
+            target_temperature: (float) requested temperature in Celsius
+            temperature_tolerance: (float) allowed deviation from target_temperature in Celsius, default .5
+            target_frequency: (float) requested shaker frequency in Hz, None if not shaking
+            frequency_tolerance: (float) allowed deviation from target_frequency in Hz, default .5
+            target_amplitude: (float) requested shaker amplitude in mm, None if not shaking
+            amplitude_tolerance: (float) allowed deviation from target_amplitude in mm, default .2
+        """
+        self.target_temperature = target_temperature
+        self.temperature = ToleranceTracker(target_temperature, temperature_tolerance)
+        self.sensors = [RunningStats(), RunningStats(), RunningStats()]
+        self.sensor_disagreement = RunningStats()
+        self.frequency = (
+            ToleranceTracker(target_frequency, frequency_tolerance)
+            if target_frequency is not None
+            else None
+        )
+        self.amplitude = (
+            ToleranceTracker(target_amplitude, amplitude_tolerance)
+            if target_amplitude is not None
+            else None
+        )
+        self.heating = None
+        self.reached_target = False
+        self.overshoot = 0.0
+        # readings that could not be taken, per channel
+        self.missed_samples = {
+            "RAT": 0,
+            "RAT2": 0,
+            "RAT3": 0,
+            "shaker_frequency": 0,
+            "shaker_amplitude": 0,
+        }
+
+    def add_temperatures(self, timestamp, temperatures):
+        """Adds one reading from each temperature sensor
+
+        Arguments:
+            timestamp: (float) time of the reading in seconds
+            temperatures: (list of float) main sensor (RAT) first, then RAT2 and RAT3. Unavailable sensors may be None
+        """
+        readings = [value for value in temperatures if value is not None]
+        for name, sensor, value in zip(["RAT", "RAT2", "RAT3"], self.sensors, temperatures):
+            if value is None:
+                self.missed_samples[name] += 1
+            else:
+                sensor.update(value)
+        if len(readings) > 1:
+            self.sensor_disagreement.update(max(readings) - min(readings))
+
+        main = temperatures[0]
+        if main is None:
+            return
+        self.temperature.update(timestamp, main)
+
+        # overshoot is how far the main sensor passes the target after first reaching it,
+        # in the direction it was approaching from
+        if self.heating is None:
+            self.heating = main <= self.target_temperature
+        past_target = (main - self.target_temperature) if self.heating else (self.target_temperature - main)
+        if not self.reached_target and past_target >= -self.temperature.tolerance:
+            self.reached_target = True
+        if self.reached_target:
+            self.overshoot = max(self.overshoot, past_target)
+
+    def add_shaker(self, timestamp, frequency=None, amplitude=None):
+        """Adds one actual shaker frequency (Hz) and amplitude (mm) reading taken at timestamp (seconds). Unavailable readings may be None"""
+        if self.frequency is not None:
+            if frequency is None:
+                self.missed_samples["shaker_frequency"] += 1
+            else:
+                self.frequency.update(timestamp, frequency)
+        if self.amplitude is not None:
+            if amplitude is None:
+                self.missed_samples["shaker_amplitude"] += 1
+            else:
+                self.amplitude.update(timestamp, amplitude)
+
+    def summary(self):
+        """Returns the QC summary for the incubation as a dict"""
+        return {
+            "temperature": dict(
+                self.temperature.summary(),
+                reached_target=self.reached_target,
+                overshoot=round(self.overshoot, 2) if self.reached_target else None,
+            ),
+            "sensors": {
+                name: stats.summary()
+                for name, stats in zip(["RAT", "RAT2", "RAT3"], self.sensors)
+            },
+            "sensor_disagreement": self.sensor_disagreement.summary(),
+            "shaker_frequency": self.frequency.summary() if self.frequency is not None else None,
+            "shaker_amplitude": self.amplitude.summary() if self.amplitude is not None else None,
+            "missed_samples": dict(self.missed_samples),
+        }
@@ -7,6 +7,8 @@ import traceback
 
 import clr
 
+from inheco_delay_profile import DelayProfile, profile_path
+
 
 class Interface:
     """
@@ -17,8 +19,23 @@ class Interface:
         self,
         dll_path=r"C:\\Program Files\\INHECO\\Incubator-Control\\ComLib.dll",
         port="COM5",
+        command_timeout=10.0,
+        device_id=2,
+        stack_floor=0,
+        serial_number=None,
+        profile_dir=".",
     ):
-        """Initializes and opens the connection to the incubator"""
+        """Initializes and opens the connection to the incubator
+
+        Arguments:
+            dll_path: (str) path to the incubator control dll (ComLib.dll)
+            port: (str) COM port the incubator is connected to, default "COM5"
+            command_timeout: (float) seconds a command may take beyond its read delay before it is abandoned, default 10 seconds
+            device_id: (int) ID of the inheco device, default 2
+            stack_floor: (int) level of the inheco device, default 0
+            serial_number: (str) optional device serial number, used to pick the delay profile
+            profile_dir: (str) directory holding delay profiles, default current directory
+        """
 
         # set up logger
         self.logger = logging.getLogger(__name__)
@@ -28,32 +45,76 @@ class Interface:
         from IncubatorCom import Com
 
         self.incubator_com = Com()
+        self.port = port
+        self.command_timeout = command_timeout
+        self.device_id = device_id
+        self.stack_floor = stack_floor
+
+        # per-device read delays, see inheco_delay_profile.calibrate()
+        self.delay_profile = DelayProfile.load(
+            profile_path(port, device_id, serial_number, profile_dir)
+        )
+
+        # connection health, cleared when a command misses its deadline
+        self.connected = False
+        self.last_heartbeat = None
+        self.heartbeat_active = False
+        self.watchdog_thread = None
+        self.watchdog_stop = threading.Event()
+        self.reconnect_needed = threading.Event()
+
+        # last commanded setpoints, replayed onto the device after a reconnect
+        self.last_setpoints = {
+            "temperature": None,
+            "heater": None,
+            "shaker_parameters": None,
+            "shaker": None,
+        }
+
         self.open_connection(port)
 
     # DEVICE CONTROL
     def open_connection(self, port):
         """Opens the connection to the incubator over the specified COM port"""
         with self.lock:
-            response = self.incubator_com.openCom(port)
-            if response == 77:
-                self.logger.info("Com connection opened successfully")
-                print("Com connection opened successfully")
-            else:
-                # response 170 means failed
-                self.logger.error("Failed to open the Inheco incubator Com connection")
-                raise Exception("Failed to open Inheco incubator Com connection")
+            response = self._open_com(port)
+            self.port = port
+            self.connected = True
             return response
 
     def close_connection(self):
         """Closes any existing open connection, no response expected on success or fail"""
+        self.stop_watchdog()
         with self.lock:
-            self.incubator_com.closeCom()
-            self.logger.info("Com connection closed")
-            print("Com connection closed")
+            self._close_com()
+
+    def _open_com(self, port):
+        """Opens the COM port, caller must hold self.lock"""
+        response = self._call_with_deadline(
+            self.incubator_com.openCom, port, timeout=self.command_timeout
+        )
+        if response == 77:
+            self.logger.info("Com connection opened successfully")
+            print("Com connection opened successfully")
+        else:
+            # response 170 means failed
+            self.connected = False
+            self.logger.error("Failed to open the Inheco incubator Com connection")
+            raise ConnectionError("Failed to open Inheco incubator Com connection")
+        return response
+
+    def _close_com(self):
+        """Closes the COM port, caller must hold self.lock"""
+        self.connected = False
+        self._call_with_deadline(
+            self.incubator_com.closeCom, timeout=self.command_timeout
+        )
+        self.logger.info("Com connection closed")
+        print("Com connection closed")
 
     def initialize_device(self):
         """Initializes the Inheco Single Plate Incubator Shaker Device through the open connection."""
-        self.send_message("AID", read_delay=3)
+        self.send_message("AID")
         self.logger.info("Inheco incubator initialized")
         print("Inheco incubator initialized")
 
@@ -61,9 +122,10 @@ class Interface:
         """Resets the Inheco Single Plate Incubator Device
         Note: seems to respond 88 regardless of success or failure
         """
-        response = self.send_message(
-            "SRS", read_delay=5
-        )  # wait 5 seconds for device to reset before reading response
+        response = self.send_message("SRS")
+        # the reset clears the device setpoints, so don't restore them on a later reconnect
+        for name in self.last_setpoints:
+            self.last_setpoints[name] = None
         self.logger.info("device reset")
         print("device reset")
         return response
@@ -86,6 +148,19 @@ class Interface:
         self.logger.info(f"get actual temperature: {temperature}")
         return temperature
 
+    def get_sensor_temperatures(self):
+        """Returns the actual temperatures measured by all three incubator sensors, main sensor (RAT) first, then "RAT2" and "RAT3".
+        A sensor that can't be read is returned as None so the others are still reported."""
+        temperatures = []
+        for message in ["RAT", "RAT2", "RAT3"]:
+            try:
+                temperatures.append(float(self.send_message(message)) / 10)
+            except Exception as e:
+                self.logger.error(f"Unable to read temperature sensor {message}: {e}")
+                temperatures.append(None)
+        self.logger.debug(f"get sensor temperatures: {temperatures}")
+        return temperatures
+
     def get_target_temperature(self):
         """Returns the set target temperature of the incubator"""
         response = self.send_message("RTT")
@@ -99,6 +174,7 @@ class Interface:
             self.logger.info("setting target temperature")
             message = "STT" + str(int(temperature * 10))
             response = self.send_message(message)
+            self.last_setpoints["temperature"] = message
             self.logger.debug(f"set target temperature com response: {response}")
             return response
         else:
@@ -110,6 +186,7 @@ class Interface:
         Note: can read the set value with self.send_message("RHE"). 0 = off, 1 = on.
         """
         self.send_message("SHE1")
+        self.last_setpoints["heater"] = "SHE1"
         self.logger.info("started heater")
 
     def stop_heater(self):
@@ -117,6 +194,7 @@ class Interface:
         Note: can read the set value with self.send_message("RHE"). 0 = off, 1 = on.
         """
         self.send_message("SHE")
+        self.last_setpoints["heater"] = "SHE"
         self.logger.info("stopped heater")
 
     def is_heater_active(self):
@@ -141,16 +219,12 @@ class Interface:
     # DOOR ACTIONS
     def open_door(self):
         """Opens the door"""
-        self.send_message(
-            "AOD", read_delay=6
-        )  # wait 6 seconds for door to open before reading com response
+        self.send_message("AOD")
         self.logger.info("opened door")
 
     def close_door(self):
         """Closes the door"""
-        self.send_message(
-            "ACD", read_delay=7
-        )  # wait 7 seconds for door to close before reading com response
+        self.send_message("ACD")
         self.logger.info("closed door")
 
     def report_door_status(self):
@@ -188,7 +262,8 @@ class Interface:
             None
         """
         if status in [1, "ND"]:
-            self.send_message("ASE" + str(status), read_delay=3)
+            self.send_message("ASE" + str(status))
+            self.last_setpoints["shaker"] = "ASE" + str(status)
             self.logger.info("started shaker")
         else:
             self.logger.error("Value Error: invalid status in start_shaker method")
@@ -196,7 +271,8 @@ class Interface:
 
     def stop_shaker(self):
         """Disables the device shaking element"""
-        self.send_message("ASE0", read_delay=5)
+        self.send_message("ASE0")
+        self.last_setpoints["shaker"] = "ASE0"
         self.logger.info("stopped shaker")
 
     def is_shaker_active(self):
@@ -223,6 +299,20 @@ class Interface:
             print("Unable to parse is_shaker_active response")
             raise (e)
 
+    def get_actual_shaker_frequency(self):
+        """Returns the actual shaker frequency on the x axis in Hz, read with "RFX1" """
+        response = self.send_message("RFX1")
+        frequency = float(response) / 10
+        self.logger.debug(f"get actual shaker frequency: {frequency}")
+        return frequency
+
+    def get_actual_shaker_amplitude(self):
+        """Returns the actual shaker amplitude on the x axis in mm, read with "RAX1" """
+        response = self.send_message("RAX1")
+        amplitude = float(response) / 10
+        self.logger.debug(f"get actual shaker amplitude: {amplitude}")
+        return amplitude
+
     def set_shaker_parameters(self, amplitude: float = 2.0, frequency: float = 14.2):
         """Sets the shaking parameters
 
@@ -248,7 +338,7 @@ class Interface:
 
             if 0 <= amplitude <= 30 and 66 <= frequency <= 300:
                 # Message formatting = SSP + str(amplitude_x) + srt(amplitude_y) + str(frequency_x) + str(frequency_y) + str(phase_shift)
-                self.send_message(
+                message = (
                     "SSP"
                     + str(amplitude)
                     + ","
@@ -260,6 +350,8 @@ class Interface:
                     + ","
                     + str(phase_shift)
                 )
+                self.send_message(message)
+                self.last_setpoints["shaker_parameters"] = message
                 self.logger.info("shaker parameters set")
             else:
                 self.logger.error("Error: invalid amplitude or frequency input values in set_shaker_parameters method")
@@ -274,43 +366,327 @@ class Interface:
             raise e
 
     # HELPER COMMANDS
-    def send_message(self, message_string, device_id=2, stack_floor=0, read_delay=0.5):
+    def send_message(
+        self,
+        message_string,
+        device_id=None,
+        stack_floor=None,
+        read_delay=None,
+        timeout=None,
+    ):
         """Formats and sends message to Inheco Device, then collects device response
 
         Arguments:
             message_string: (str) message string to send to inheco device
-            device_id: (int) ID of the inheco device that will receive the message, default 2
-            stack_floor: (int) level of the inheco device. Need to specify in case several devices are stacked, default 0
-            read_delay: (float) seconds to wait before reading com response, default .5 seconds
+            device_id: (int) ID of the inheco device that will receive the message, defaults to self.device_id
+            stack_floor: (int) level of the inheco device. Need to specify in case several devices are stacked, defaults to self.stack_floor
+            read_delay: (float) seconds to wait before reading com response, defaults to the delay profile value for the command
+            timeout: (float) seconds allowed beyond read_delay for the device to respond, defaults to self.command_timeout
 
         Returns:
             formatted_response: response from the Com port without extra characters
+
+        Raises:
+            TimeoutError: if the device is busy or does not respond before the deadline
+            ConnectionError: if the connection is down and waiting to be recovered
+        """
+        if device_id is None:
+            device_id = self.device_id
+        if stack_floor is None:
+            stack_floor = self.stack_floor
+        if read_delay is None:
+            read_delay = self.delay_profile.read_delay(message_string)
+        if timeout is None:
+            timeout = self.command_timeout
+        deadline = read_delay + timeout
+
+        # fail fast while the watchdog is recovering the connection instead of waiting on the lock
+        if not self.connected:
+            self.reconnect_needed.set()
+            raise ConnectionError(f"Inheco incubator connection is down, unable to send {message_string}")
+
+        # don't queue forever behind a command that is itself stuck
+        if not self.lock.acquire(timeout=deadline):
+            self.logger.error(f"timed out waiting for device lock to send {message_string}")
+            raise TimeoutError(f"Device busy, unable to send {message_string} within {deadline} seconds")
+        try:
+            if not self.connected:
+                self.reconnect_needed.set()
+                raise ConnectionError(f"Inheco incubator connection is down, unable to send {message_string}")
+            return self._send_message_locked(message_string, device_id, stack_floor, read_delay, deadline)
+        finally:
+            self.lock.release()
+
+    def _send_message_locked(self, message_string, device_id, stack_floor, read_delay, deadline):
+        """Sends message and reads response under a deadline, caller must hold self.lock"""
+        cancel = threading.Event()
+        try:
+            return self._call_with_deadline(
+                self._transact,
+                message_string,
+                device_id,
+                stack_floor,
+                read_delay,
+                cancel,
+                timeout=deadline,
+                cancel=cancel,
+            )
+        except TimeoutError:
+            # the com port can't be trusted until it has been reopened
+            self.connected = False
+            self.reconnect_needed.set()
+            self.logger.error(f"no response to {message_string} within {deadline} seconds, connection marked down")
+            raise
+
+    def _transact(self, message_string, device_id, stack_floor, read_delay, cancel):
+        """Sends message and reads the com response, with no locking or deadline.
+
+        cancel is set once the caller has given up on this command, after which the com
+        port belongs to later commands and must not be read.
         """
+        self._write_message(message_string, device_id, stack_floor)
+
+        if cancel.wait(read_delay):
+            return None
+
+        # Read COM port response
+        response = self.incubator_com.readCom()
+        self.logger.debug(f"sent message response: {response}")
+        if cancel.is_set():
+            return None
+        if not response:
+            # nothing to read yet, the device was slower than its profile allows. Keep reading
+            # until the reply arrives or the caller's deadline cancels this command, so the
+            # late reply isn't left in the buffer for the next command to read
+            self.logger.warning(f"empty response to {message_string} after {read_delay} seconds, waiting for reply")
+            while not response:
+                if cancel.wait(0.05):
+                    return None
+                response = self.incubator_com.readCom()
+                if cancel.is_set():
+                    return None
+            self.logger.debug(f"sent message late response: {response}")
+            self.delay_profile.widen(message_string)
+        formatted_response = self.format_response(response)
+        self.logger.debug(f"sent message formatted response: {formatted_response}")
 
-        with self.lock:
-            # convert message length, device ID, and stack floor to bytes
-            bytes_message_length = len(message_string) & 0xFF
-            bytes_device_ID = device_id & 0xFF
-            bytes_stack_floor = stack_floor & 0xFF
+        return formatted_response
 
-            # convert them message to byte array
-            bytes_message = bytes([ord(c) for c in message_string])
+    def _write_message(self, message_string, device_id, stack_floor):
+        """Formats and sends message over the com port without reading the response"""
+        # convert message length, device ID, and stack floor to bytes
+        bytes_message_length = len(message_string) & 0xFF
+        bytes_device_ID = device_id & 0xFF
+        bytes_stack_floor = stack_floor & 0xFF
 
-            # format the message, send over com port and collect response
-            self.incubator_com.sendMsg(
-                bytes_message, bytes_message_length, bytes_device_ID, bytes_stack_floor
-            )
-            self.logger.debug(f"sent message: bytes_message={bytes_message}, bytes_message_length={bytes_message_length}, bytes_device_ID={bytes_device_ID}, bytes_stack_floor={bytes_stack_floor}")
+        # convert them message to byte array
+        bytes_message = bytes([ord(c) for c in message_string])
+
+        # format the message, send over com port and collect response
+        self.incubator_com.sendMsg(
+            bytes_message, bytes_message_length, bytes_device_ID, bytes_stack_floor
+        )
+        self.logger.debug(f"sent message: bytes_message={bytes_message}, bytes_message_length={bytes_message_length}, bytes_device_ID={bytes_device_ID}, bytes_stack_floor={bytes_stack_floor}")
+
+    def measure_response_time(self, message_string, poll_interval=0.05, timeout=30.0):
+        """Sends message and returns the seconds until the device response can be read, used to calibrate delay profiles
 
-            time.sleep(read_delay)
+        Arguments:
+            message_string: (str) message string to send to inheco device
+            poll_interval: (float) seconds between com port reads, default .05 seconds
+            timeout: (float) seconds to wait for a response before giving up, default 30 seconds
 
-            # Read COM port response
-            response = self.incubator_com.readCom()
-            self.logger.debug(f"sent message response: {response}")
-            formatted_response = self.format_response(response)
-            self.logger.debug(f"sent message formatted response: {formatted_response}")
+        Returns:
+            elapsed: (float) seconds from sending the message to reading a response
+        """
 
-            return formatted_response
+        # set on timeout so an abandoned poll stops reading responses meant for later commands
+        stop = threading.Event()
+
+        def poll():
+            self._write_message(message_string, self.device_id, self.stack_floor)
+            start = time.monotonic()
+            while not stop.is_set() and time.monotonic() - start < timeout:
+                response = self.incubator_com.readCom()
+                if stop.is_set():
+                    break
+                if response:
+                    elapsed = time.monotonic() - start
+                    self.format_response(response)
+                    return elapsed
+                time.sleep(poll_interval)
+            return None
+
+        if not self.lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Device busy, unable to send {message_string} within {timeout} seconds")
+        try:
+            elapsed = self._call_with_deadline(poll, timeout=timeout, cancel=stop)
+            if elapsed is None:
+                raise TimeoutError(f"no response to {message_string} within {timeout} seconds")
+            return elapsed
+        except TimeoutError:
+            stop.set()
+            # the com port can't be trusted until it has been reopened
+            self.connected = False
+            self.reconnect_needed.set()
+            self.logger.error(f"no response to {message_string} within {timeout} seconds during calibration, connection marked down")
+            raise
+        finally:
+            self.lock.release()
+
+    def _call_with_deadline(self, function, *args, timeout, cancel=None):
+        """Runs function in a worker thread and returns its result, raising TimeoutError if it runs past timeout seconds.
+
+        Calls into the dll can't be cancelled, so a call that misses its deadline is
+        abandoned on its daemon thread and the connection is left for the watchdog to reopen.
+        If given, cancel is set on timeout so the abandoned call can stop before touching the port again.
+        """
+        result = {}
+
+        def target():
+            try:
+                result["value"] = function(*args)
+            except Exception as e:
+                result["error"] = e
+
+        worker = threading.Thread(target=target, daemon=True)
+        worker.start()
+        worker.join(timeout)
+        if worker.is_alive():
+            if cancel is not None:
+                cancel.set()
+            raise TimeoutError(f"{getattr(function, '__name__', function)} did not return within {timeout} seconds")
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+    # CONNECTION WATCHDOG
+    def start_watchdog(self, heartbeat_interval=5.0, heartbeat_timeout=2.0):
+        """Starts a background thread that checks the connection while the device is idle and recovers it on failure
+
+        Arguments:
+            heartbeat_interval: (float) seconds between heartbeat reads, default 5 seconds
+            heartbeat_timeout: (float) seconds allowed for a heartbeat response, default 2 seconds
+        """
+        if self.watchdog_thread is not None and self.watchdog_thread.is_alive():
+            return
+        self.watchdog_stop.clear()
+        self.watchdog_thread = threading.Thread(
+            target=self._watchdog_loop,
+            args=(heartbeat_interval, heartbeat_timeout),
+            name="inheco_watchdog",
+            daemon=True,
+        )
+        self.watchdog_thread.start()
+        self.logger.info("connection watchdog started")
+
+    def stop_watchdog(self):
+        """Stops the connection watchdog thread, if running"""
+        self.watchdog_stop.set()
+        if self.watchdog_thread is None:
+            return
+        if self.watchdog_thread is not threading.current_thread():
+            self.watchdog_thread.join(timeout=self.command_timeout)
+        self.watchdog_thread = None
+        self.logger.info("connection watchdog stopped")
+
+    def _watchdog_loop(self, heartbeat_interval, heartbeat_timeout):
+        """Runs heartbeat reads when idle and reconnects when a command or heartbeat fails"""
+        while not self.watchdog_stop.is_set():
+            # wake early if a command reports a dead connection
+            self.reconnect_needed.wait(heartbeat_interval)
+            if self.watchdog_stop.is_set():
+                break
+
+            if self.reconnect_needed.is_set() or not self.connected:
+                try:
+                    self.reconnect()
+                except Exception as e:
+                    self.logger.error(f"watchdog unable to recover connection: {e}")
+                    self.watchdog_stop.wait(heartbeat_interval)
+                continue
+
+            # only check the connection while no other command is using it
+            if not self.lock.acquire(blocking=False):
+                continue
+            self.heartbeat_active = True
+            try:
+                read_delay = self.delay_profile.read_delay("REF")
+                self._send_message_locked("REF", self.device_id, self.stack_floor, read_delay, read_delay + heartbeat_timeout)
+                self.last_heartbeat = time.time()
+            except (TimeoutError, ConnectionError) as e:
+                self.logger.warning(f"heartbeat failed: {e}")
+                self.connected = False
+                self.reconnect_needed.set()
+            except Exception as e:
+                # the device answered, so the link itself is fine
+                self.logger.error(f"heartbeat returned an error response: {e}")
+            finally:
+                self.heartbeat_active = False
+                self.lock.release()
+
+    def reconnect(self, max_attempts=5, initial_backoff=0.5, max_backoff=8.0):
+        """Closes and reopens the COM connection with bounded backoff. If the device reports error flags it is re-initialized and the last setpoints are replayed
+
+        Arguments:
+            max_attempts: (int) number of reconnect attempts before giving up, default 5
+            initial_backoff: (float) seconds to wait after the first failed attempt, doubled after each failure, default .5 seconds
+            max_backoff: (float) longest wait between attempts, default 8 seconds
+
+        Raises:
+            ConnectionError: if the connection could not be recovered
+        """
+        backoff = initial_backoff
+        for attempt in range(1, max_attempts + 1):
+            self.logger.warning(f"reconnecting to Inheco incubator on {self.port}, attempt {attempt} of {max_attempts}")
+            if not self.lock.acquire(timeout=self.command_timeout):
+                self.logger.error("unable to acquire device lock for reconnect")
+            else:
+                try:
+                    try:
+                        self._close_com()
+                    except Exception as e:
+                        self.logger.warning(f"error closing com connection during reconnect: {e}")
+                    self._open_com(self.port)
+                    # reopening the port doesn't reset the device, only re-initialize if it lost its state
+                    if self._needs_initialization():
+                        read_delay = self.delay_profile.read_delay("AID")
+                        self._send_message_locked("AID", self.device_id, self.stack_floor, read_delay, read_delay + self.command_timeout)
+                        self.logger.info("Inheco incubator re-initialized")
+                        self._replay_setpoints()
+                    self.connected = True
+                    self.reconnect_needed.clear()
+                    self.last_heartbeat = time.time()
+                    self.logger.info("Inheco incubator connection recovered")
+                    print("Inheco incubator connection recovered")
+                    return
+                except Exception as e:
+                    self.connected = False
+                    self.logger.error(f"reconnect attempt {attempt} failed: {e}")
+                finally:
+                    self.lock.release()
+
+            if self.watchdog_stop.wait(backoff):
+                break
+            backoff = min(backoff * 2, max_backoff)
+
+        raise ConnectionError(f"Unable to recover Inheco incubator connection on {self.port}")
+
+    def _needs_initialization(self):
+        """Returns True if the device reports error flags after a reconnect, caller must hold self.lock"""
+        read_delay = self.delay_profile.read_delay("REF")
+        response = self._send_message_locked("REF", self.device_id, self.stack_floor, read_delay, read_delay + self.command_timeout)
+        self.logger.debug(f"error flags after reconnect: {response}")
+        return response != "0"
+
+    def _replay_setpoints(self):
+        """Re-sends the last commanded setpoints after a reconnect, caller must hold self.lock"""
+        for name, message in self.last_setpoints.items():
+            if message is None:
+                continue
+            read_delay = self.delay_profile.read_delay(message)
+            self._send_message_locked(message, self.device_id, self.stack_floor, read_delay, read_delay + self.command_timeout)
+            self.logger.info(f"replayed {name} setpoint: {message}")
 
     def format_response(self, response: str):
         """Extracts important message details from longer com response message
@@ -334,8 +710,8 @@ class Interface:
 
     @property
     def is_busy(self) -> bool:
-        """Returns True if incubator busy, False otherwise"""
-        if self.lock.locked():
+        """Returns True if incubator busy, False otherwise. A watchdog heartbeat alone doesn't count as busy"""
+        if self.lock.locked() and not self.heartbeat_active:
             return True
         else:
             return False
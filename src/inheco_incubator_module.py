@@ -18,6 +18,7 @@ from wei.types.step_types import (
     StepResponse,
 )
 
+from inheco_incubation_qc import IncubationQC
 from inheco_incubator_interface import Interface
 
 # create logger
@@ -56,6 +57,36 @@ rest_module.arg_parser.add_argument(
     help="Serial port for communicating with the device",
     default="COM5",
 )
+rest_module.arg_parser.add_argument(
+    "--command_timeout",
+    type=float,
+    help="seconds a device command may run past its read delay before it is abandoned",
+    default=10.0,
+)
+rest_module.arg_parser.add_argument(
+    "--heartbeat_interval",
+    type=float,
+    help="seconds between connection heartbeat checks while the device is idle",
+    default=5.0,
+)
+rest_module.arg_parser.add_argument(
+    "--qc_sample_interval",
+    type=float,
+    help="seconds between temperature and shaker QC readings while waiting for an incubation to finish",
+    default=10.0,
+)
+rest_module.arg_parser.add_argument(
+    "--serial_number",
+    type=str,
+    help="(optional) serial number of the Inheco Incubator device, used to pick its delay profile",
+    default=None,
+)
+rest_module.arg_parser.add_argument(
+    "--profile_dir",
+    type=str,
+    help="directory holding calibrated delay profiles",
+    default=".",
+)
 
 # parse the arguments
 args = rest_module.arg_parser.parse_args()
@@ -71,10 +102,25 @@ def inheco_startup(state: State):
     """Initializes the inheco interface and opens the COM connection"""
     logger.info("startup called")
     state.incubator = None
-    state.incubator = Interface()
+    state.incubator = Interface(
+        dll_path=args.dll_path,
+        port=args.device,
+        command_timeout=args.command_timeout,
+        device_id=args.device_id,
+        stack_floor=args.stack_floor,
+        serial_number=args.serial_number,
+        profile_dir=args.profile_dir,
+    )
     state.incubator.initialize_device()
+    state.incubator.start_watchdog(heartbeat_interval=args.heartbeat_interval)
     state.is_incubating_only = False
     state.incubation_seconds_remaining = 0
+    state.cached_current_shaker_active = None
+    state.cached_current_heater_active = None
+    state.cached_current_actual_temperature = None
+    state.cached_current_target_temperature = None
+    state.cached_state_timestamp = None
+    state.last_incubation_qc = None
     logger.info("startup complete")
 
 @rest_module.shutdown()
@@ -97,17 +143,26 @@ def inheco_state_handler(state: State) -> ModuleState:
             error=state.error,
         )
 
-    if not incubator.is_busy or (incubator.is_busy and state.is_incubating_only):
+    if incubator.connected and (not incubator.is_busy or state.is_incubating_only):
         # query for fresh state details and save to cache
         logger.debug("querying fresh state")
-        state.cached_current_shaker_active = incubator.is_shaker_active()
-        state.cached_current_heater_active = incubator.is_heater_active()
-        state.cached_current_actual_temperature = incubator.get_actual_temperature()
-        state.cached_current_target_temperature = incubator.get_target_temperature()
+        try:
+            state.cached_current_shaker_active = incubator.is_shaker_active()
+            state.cached_current_heater_active = incubator.is_heater_active()
+            state.cached_current_actual_temperature = incubator.get_actual_temperature()
+            state.cached_current_target_temperature = incubator.get_target_temperature()
+            state.cached_state_timestamp = time.time()
+        except Exception as e:
+            logger.error(f"Unable to query fresh state, using cached state: {e}")
     else:
         logger.debug("using cached state")
 
     # if the shaker is actually busy, the previous cashed values will be returned
+    # along with how old they are so stale values can be recognized
+    state_age_seconds = None
+    if state.cached_state_timestamp is not None:
+        state_age_seconds = round(time.time() - state.cached_state_timestamp, 1)
+
     return ModuleState.model_validate(
         {
             "status": state.status,
@@ -117,6 +172,10 @@ def inheco_state_handler(state: State) -> ModuleState:
             "shaker_active": state.cached_current_shaker_active,
             "heater_active": state.cached_current_heater_active,
             "incubation_seconds_remaining": state.incubation_seconds_remaining,
+            "connected": incubator.connected,
+            "last_heartbeat": incubator.last_heartbeat,
+            "state_age_seconds": state_age_seconds,
+            "last_incubation_qc": state.last_incubation_qc,
         }
     )
 
@@ -214,6 +273,10 @@ def incubate(
         "True if action should block until the specified incubation time has passed, False to continue immediately after starting the incubation",
     ] = False,
     incubation_time: Annotated[int, "Time to incubate in seconds"] = None,
+    temperature_tolerance: Annotated[
+        float,
+        "allowed deviation from the target temperature in celsius when reporting time in tolerance, default 0.5",
+    ] = 0.5,
 ) -> StepResponse:
     """Starts incubation at the specified temperature, optionally shakes, and optionally blocks all other actions until incubation complete"""
 
@@ -256,12 +319,29 @@ def incubate(
 
         print(f"Incubation action: Starting incubation for {incubation_time} seconds")
 
+        # summarize the conditions the plate sees while incubating
+        shaking = not shaker_frequency == 0
+        qc = IncubationQC(
+            target_temperature=temperature,
+            temperature_tolerance=temperature_tolerance,
+            target_frequency=shaker_frequency if shaking else None,
+            target_amplitude=2.0 if shaking else None,  # set_shaker_parameters default amplitude
+        )
+
+        start_time = time.monotonic()
+        next_sample_time = start_time
         while incubation_seconds_completed < total_incubation_seconds:
+            if time.monotonic() >= next_sample_time:
+                sample_incubation_qc(state.incubator, qc, shaking)
+                # schedule from now so a slow sample doesn't cause back-to-back catch-up reads
+                next_sample_time = time.monotonic() + args.qc_sample_interval
             time.sleep(1)
-            incubation_seconds_completed += 1
-            state.incubation_seconds_remaining = (
-                total_incubation_seconds - incubation_seconds_completed
+            # use the clock so time spent reading the device counts towards incubation
+            incubation_seconds_completed = int(time.monotonic() - start_time)
+            state.incubation_seconds_remaining = max(
+                total_incubation_seconds - incubation_seconds_completed, 0
             )
+        sample_incubation_qc(state.incubator, qc, shaking)
         logger.info("incubation time complete")
 
         # reset the incubation_time_remaining variable for next actions
@@ -270,10 +350,33 @@ def incubate(
         # stop shaking after incubation complete
         state.incubator.stop_shaker()
 
+        incubation_qc = qc.summary()
+        state.last_incubation_qc = incubation_qc
+        logger.info(f"incubation QC: {incubation_qc}")
+
         print("Incubation action: Incubation complete")
 
         logger.info("incubation completes")
-        return StepResponse.step_succeeded()
+        return StepResponse.step_succeeded(data={"incubation_qc": incubation_qc})
+
+
+def sample_incubation_qc(incubator: Interface, qc: IncubationQC, shaking: bool):
+    """Reads the temperature sensors, and the actual shaker frequency and amplitude if shaking, into the incubation QC summary"""
+    timestamp = time.monotonic()
+    qc.add_temperatures(timestamp, incubator.get_sensor_temperatures())
+    if shaking:
+        # read each channel separately so one failure doesn't drop the other
+        readings = {}
+        for channel, read in [
+            ("frequency", incubator.get_actual_shaker_frequency),
+            ("amplitude", incubator.get_actual_shaker_amplitude),
+        ]:
+            try:
+                readings[channel] = read()
+            except Exception as e:
+                logger.error(f"Unable to read shaker {channel} for incubation QC: {e}")
+                readings[channel] = None
+        qc.add_shaker(timestamp, **readings)
 
 
 # ****************#